@@ -1,9 +1,20 @@
 import os
 import json
+import re
 import logging
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
+from collections import defaultdict
 import time
+import asyncio
+import bisect
+import random
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import gspread
+import google.auth.transport.requests
+from gspread.utils import absolute_range_name
+import requests
+from requests.adapters import HTTPAdapter
 from oauth2client.service_account import ServiceAccountCredentials
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -15,113 +26,530 @@ from telegram.ext import (
     ContextTypes,
 )
 from dotenv import load_dotenv
-import pytz
 
 # Configure logging
 load_dotenv()
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+# httpx logs every Telegram request at INFO; keep that out of the default output
+logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # Load environment variables
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 GOOGLE_SHEETS_JSON = os.getenv("GOOGLE_SHEETS_JSON")
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
-ADMINS = [int(x) for x in os.getenv("ADMINS", "").split(",") if x]
+ADMINS = {int(x) for x in os.getenv("ADMINS", "").split(",") if x}
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0"))
 DRIVERS_WORKSHEET_NAME = os.getenv("DRIVERS_WORKSHEET_NAME", "Drivers")
 LOG_WORKSHEET_NAME = os.getenv("LOG_WORKSHEET_NAME", "Log")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Telegram sends the secret with every webhook update, so forged requests to the URL are
+# rejected; the path is kept separate from the bot token so the token never shows up in URLs
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+PORT = int(os.getenv("PORT", "8443"))
 
 # Validate environment variables
 if not all([TELEGRAM_TOKEN, GOOGLE_SHEETS_JSON, SPREADSHEET_ID]):
     logger.error("Missing one of TELEGRAM_BOT_TOKEN, GOOGLE_SHEETS_JSON, or SPREADSHEET_ID")
     exit(1)
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    logger.error("WEBHOOK_SECRET must be set when WEBHOOK_URL is used")
+    exit(1)
 
-# Initialize Google Sheets
-try:
-    creds_dict = json.loads(GOOGLE_SHEETS_JSON)
-    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scopes)
-    gs = gspread.authorize(creds)
-    sh = gs.open_by_key(SPREADSHEET_ID)
-
-    # Initialize worksheets
+# Initialize Google Sheets lazily on first use, so a slow or failing Google API
+# doesn't block or crash startup. A failed attempt is not cached and is retried
+# on the next request, where the handler reports the error to the user.
+# This blocks on several Google requests, so only call it through ensure_sheets().
+@functools.lru_cache(maxsize=1)
+def _sheets():
     try:
-        sheet_log = sh.worksheet(LOG_WORKSHEET_NAME)
-        # Verify headers
-        log_data = sheet_log.get_all_values()
+        creds_dict = json.loads(GOOGLE_SHEETS_JSON)
+        scopes = ["https://www.googleapis.com/auth/spreadsheets"]
+        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scopes)
+        gs = gspread.authorize(creds)
+        # gspread waits forever by default; a hung request would hold a Sheets worker indefinitely
+        gs.set_timeout(SHEETS_TIMEOUT)
+        # Keep TLS connections to Google alive and shared across worker threads
+        gs.http_client.session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+        sh = gs.open_by_key(SPREADSHEET_ID)
+
+        # One metadata request resolves every worksheet and one batchGet reads them all,
+        # instead of a lookup plus a read per worksheet
+        worksheets = {ws.title: ws for ws in sh.worksheets()}
+        ranges = {LOG_WORKSHEET_NAME: "A:D", DRIVERS_WORKSHEET_NAME: "A:B", "Cars": "A:A"}
+        present = [title for title in ranges if title in worksheets]
+        value_ranges = sh.values_batch_get([absolute_range_name(title, ranges[title]) for title in present])
+        values = {title: vr.get("values", []) for title, vr in zip(present, value_ranges.get("valueRanges", []))}
+
+        # Initialize worksheets
         required_headers = ["Timestamp", "Driver Name", "Car Plate", "Action"]
-        if not log_data or log_data[0] != required_headers:
-            logger.warning(f"Log worksheet '{LOG_WORKSHEET_NAME}' missing headers. Resetting them...")
-            sheet_log.clear()
+        sheet_log = worksheets.get(LOG_WORKSHEET_NAME)
+        if sheet_log is None:
+            logger.warning("Log worksheet '%s' not found. Creating it...", LOG_WORKSHEET_NAME)
+            sheet_log = sh.add_worksheet(title=LOG_WORKSHEET_NAME, rows=100, cols=4)
             sheet_log.append_row(required_headers)
-    except gspread.exceptions.WorksheetNotFound:
-        logger.warning(f"Log worksheet '{LOG_WORKSHEET_NAME}' not found. Creating it...")
-        sheet_log = sh.add_worksheet(title=LOG_WORKSHEET_NAME, rows=100, cols=4)
-        sheet_log.append_row(["Timestamp", "Driver Name", "Car Plate", "Action"])
+            log_data = []
+        else:
+            # Verify headers
+            log_data = values[LOG_WORKSHEET_NAME]
+            if not log_data or log_data[0] != required_headers:
+                logger.warning("Log worksheet '%s' missing headers. Resetting them...", LOG_WORKSHEET_NAME)
+                sheet_log.clear()
+                sheet_log.append_row(required_headers)
+                log_data = [required_headers]
 
-    try:
-        sheet_drivers = sh.worksheet(DRIVERS_WORKSHEET_NAME)
-        # Check and create headers if missing
-        driver_data = sheet_drivers.get_all_values()
-        if not driver_data or driver_data[0] != ["Name", "User ID"]:
-            logger.warning(f"Drivers worksheet '{DRIVERS_WORKSHEET_NAME}' missing headers. Creating them...")
-            sheet_drivers.clear()
+        sheet_drivers = worksheets.get(DRIVERS_WORKSHEET_NAME)
+        if sheet_drivers is None:
+            logger.warning("Drivers worksheet '%s' not found. Creating it...", DRIVERS_WORKSHEET_NAME)
+            sheet_drivers = sh.add_worksheet(title=DRIVERS_WORKSHEET_NAME, rows=100, cols=2)
             sheet_drivers.append_row(["Name", "User ID"])
-    except gspread.exceptions.WorksheetNotFound:
-        logger.warning(f"Drivers worksheet '{DRIVERS_WORKSHEET_NAME}' not found. Creating it...")
-        sheet_drivers = sh.add_worksheet(title=DRIVERS_WORKSHEET_NAME, rows=100, cols=2)
-        sheet_drivers.append_row(["Name", "User ID"])
+            driver_data = []
+        else:
+            # Check and create headers if missing
+            driver_data = values[DRIVERS_WORKSHEET_NAME]
+            if not driver_data or driver_data[0] != ["Name", "User ID"]:
+                logger.warning("Drivers worksheet '%s' missing headers. Creating them...", DRIVERS_WORKSHEET_NAME)
+                sheet_drivers.clear()
+                sheet_drivers.append_row(["Name", "User ID"])
+                driver_data = []
 
-    sheet_cars = sh.worksheet("Cars")
-except gspread.exceptions.WorksheetNotFound as e:
-    logger.error(f"Worksheet not found: {e}")
-    exit(1)
-except Exception as e:
-    logger.error(f"Failed to initialize Google Sheets: {e}")
-    exit(1)
+        sheet_cars = worksheets.get("Cars")
+        if sheet_cars is None:
+            raise gspread.exceptions.WorksheetNotFound("Cars")
+        cars_data = values["Cars"]
+    except gspread.exceptions.WorksheetNotFound as e:
+        logger.error("Worksheet not found: %s", e)
+        raise
+    except Exception as e:
+        logger.error("Failed to initialize Google Sheets: %s", e)
+        raise
 
-# Define keyboard layouts
-MAIN_MENU = ReplyKeyboardMarkup([
-    ["🚗 Take Car", "↩️ Return Car"],
-    ["⬅️ Main Menu"]
-], resize_keyboard=True)
+    # Reuse the rows read for header validation to build the car state index and seed the
+    # driver and car caches, so the first handlers don't read them again
+    load_car_state(log_data[1:])
+    _log_rows["count"] = max(len(log_data), 1)
+    now = time.monotonic()
+    _drivers_cache.update(ids={row[1] for row in driver_data[1:] if len(row) > 1 and row[1]}, expires=now + DRIVERS_CACHE_TTL)
+    _cars_cache.update(plates={normalize_plate(row[0]): row[0] for row in cars_data[1:] if row and row[0]}, expires=now + CARS_CACHE_TTL)
+    return sheet_log, sheet_drivers, sheet_cars
 
-ADMIN_MENU = ReplyKeyboardMarkup([
-    ["➕ Add Car", "➖ Remove Car"],
-    ["📋 Driver List"],
-    ["📊 Status", "🔍 History"],
-    ["⬅️ Main Menu"]
-], resize_keyboard=True)
+# Run the Sheets initialization in a worker thread, once: concurrent first requests wait
+# for the same attempt instead of each starting their own
+_sheets_lock = asyncio.Lock()
+
+async def ensure_sheets():
+    if _sheets.cache_info().currsize:
+        return
+    async with _sheets_lock:
+        if not _sheets.cache_info().currsize:
+            await sheet_call(_sheets)
+
+# Updates are handled concurrently, so a lookup followed by a write on the Drivers or Cars
+# worksheet is serialized per worksheet. Otherwise two removals could both resolve the same
+# row number and the second would delete whichever row moved up into it, and two adds of one
+# plate could both pass the duplicate check.
+_drivers_sheet_lock = asyncio.Lock()
+_cars_sheet_lock = asyncio.Lock()
 
-COMBINED_MENU = ReplyKeyboardMarkup([
-    ["🚗 Take Car", "↩️ Return Car"],
+# Stand-in for a gspread Worksheet, usable once ensure_sheets() has completed. It never
+# initializes Sheets itself, as that would block the event loop.
+class _LazyWorksheet:
+    def __init__(self, index):
+        self._index = index
+
+    def __getattr__(self, name):
+        if not _sheets.cache_info().currsize:
+            raise RuntimeError("Google Sheets is not initialized; await ensure_sheets() first")
+        return getattr(_sheets()[self._index], name)
+
+sheet_log = _LazyWorksheet(0)
+sheet_drivers = _LazyWorksheet(1)
+sheet_cars = _LazyWorksheet(2)
+
+# Define keyboard layouts, built from shared rows so the combined menu can't drift
+# from the driver and admin menus
+_DRIVER_ROWS = [["🚗 Take Car", "↩️ Return Car"]]
+_ADMIN_ROWS = [
     ["➕ Add Car", "➖ Remove Car"],
     ["📋 Driver List"],
     ["📊 Status", "🔍 History"],
-    ["⬅️ Main Menu"]
-], resize_keyboard=True)
+]
+_BACK_ROW = [["⬅️ Main Menu"]]
+
+MAIN_MENU = ReplyKeyboardMarkup(_DRIVER_ROWS + _BACK_ROW, resize_keyboard=True)
+ADMIN_MENU = ReplyKeyboardMarkup(_ADMIN_ROWS + _BACK_ROW, resize_keyboard=True)
+COMBINED_MENU = ReplyKeyboardMarkup(_DRIVER_ROWS + _ADMIN_ROWS + _BACK_ROW, resize_keyboard=True)
+
+# Admins get the combined menu, drivers get the main menu
+def menu_for(user_id):
+    return COMBINED_MENU if user_id in ADMINS else MAIN_MENU
+
+# Define UAE time zone (UTC+4). The UAE has no daylight saving, so a fixed offset is exact
+# and, unlike a pytz zone, can be attached with tzinfo= directly.
+UAE_TZ = timezone(timedelta(hours=4), "GST")
+
+# Timestamp formats for Log storage and for display in messages
+LOG_TS_FORMAT = "%Y-%m-%d %H:%M"
+DISPLAY_TS_FORMAT = "%d-%m-%Y, %I:%M %p"
+
+def parse_log_ts(ts):
+    # Log timestamps are written in UAE local time, so attach the zone rather than convert.
+    # LOG_TS_FORMAT is ISO 8601 with a space separator, which fromisoformat() parses far
+    # faster than strptime().
+    return datetime.fromisoformat(ts).replace(tzinfo=UAE_TZ)
+
+# Log timestamps have minute resolution and repeat across rows, so memoize their display form
+@functools.lru_cache(maxsize=4096)
+def display_ts(ts):
+    return parse_log_ts(ts).strftime(DISPLAY_TS_FORMAT)
+
+# Take/return timestamps only change once a minute, so format the current minute once
+@functools.lru_cache(maxsize=2)
+def format_minute(minute):
+    return minute.strftime(DISPLAY_TS_FORMAT), minute.strftime(LOG_TS_FORMAT)
+
+# Cap concurrent Google Sheets requests to smooth bursts under the per-user quota
+SHEET_CONCURRENCY = 5
+# Per-request timeout for Google Sheets, so a hung request frees its worker thread
+SHEETS_TIMEOUT = float(os.getenv("SHEETS_TIMEOUT", "10"))  # seconds
+SHEET_SEM = asyncio.Semaphore(SHEET_CONCURRENCY)
+# Dedicated threads for gspread so slow Sheets calls never starve the default executor
+SHEETS_EXECUTOR = ThreadPoolExecutor(max_workers=SHEET_CONCURRENCY, thread_name_prefix="sheets")
+
+# Run a blocking gspread call in a worker thread so the event loop keeps serving updates
+async def sheet_call(func, *args, **kwargs):
+    async with SHEET_SEM:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(SHEETS_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+# Store appended values as typed (a plate like "=A1" must not become a formula) and always
+# insert new rows anchored at A1, regardless of the installed gspread's defaults
+APPEND_OPTIONS = {"value_input_option": "RAW", "insert_data_option": "INSERT_ROWS", "table_range": "A1"}
+
+# In-memory cache of registered driver IDs to avoid a Sheets round-trip per update.
+# Each cache below has a generation, bumped whenever the bot changes the cached data in
+# place. A refresh whose read started before such a change doesn't overwrite the cache,
+# since its rows may predate the change.
+DRIVERS_CACHE_TTL = int(os.getenv("DRIVERS_CACHE_TTL", "60"))  # seconds
+_drivers_cache = {"ids": set(), "expires": 0, "generation": 0}
+
+async def get_driver_ids(force=False) -> set[str]:
+    await ensure_sheets()  # Seeds the cache on first use
+    now = time.monotonic()
+    if force or now > _drivers_cache["expires"]:
+        generation = _drivers_cache["generation"]
+        # Ask for the data rows only so the header never crosses the wire
+        ids = {r[0] for r in await sheet_call(sheet_drivers.get, "B2:B") if r}
+        if _drivers_cache["generation"] == generation:
+            _drivers_cache.update(ids=ids, expires=now + DRIVERS_CACHE_TTL)
+            logger.debug("Driver IDs cache refreshed: %s", ids)
+    return _drivers_cache["ids"]
+
+def cache_driver_id(user_id, present=True):
+    if present:
+        _drivers_cache["ids"].add(user_id)
+    else:
+        _drivers_cache["ids"].discard(user_id)
+    _drivers_cache["generation"] += 1
+
+# In-memory cache of the Cars worksheet, mapping normalized plate to the plate as entered.
+# Kept current on add/remove; the TTL picks up edits made directly in the sheet.
+CARS_CACHE_TTL = int(os.getenv("CARS_CACHE_TTL", "300"))  # seconds
+_cars_cache = {"plates": {}, "expires": 0, "generation": 0}
+
+async def get_cars(force=False) -> dict[str, str]:
+    await ensure_sheets()  # Seeds the cache on first use
+    now = time.monotonic()
+    if force or now > _cars_cache["expires"]:
+        generation = _cars_cache["generation"]
+        plates = [r[0] for r in await sheet_call(sheet_cars.get, "A2:A") if r]  # Skip header
+        if _cars_cache["generation"] == generation:
+            _cars_cache.update(plates={normalize_plate(c): c for c in plates}, expires=now + CARS_CACHE_TTL)
+            logger.debug("Cars cache refreshed: %s", _cars_cache['plates'])
+    return _cars_cache["plates"]
+
+def cache_car(plate, present=True):
+    if present:
+        _cars_cache["plates"][normalize_plate(plate)] = plate
+    else:
+        _cars_cache["plates"].pop(normalize_plate(plate), None)
+    _cars_cache["generation"] += 1
+
+# Last known state of every car, keyed by normalized plate: (action, driver, timestamp), with the
+# timestamp kept as the Log's LOG_TS_FORMAT string.
+# Folded from the Log worksheet once when Sheets is initialized and updated whenever a log row is
+# appended, so handlers never have to download and scan the whole log.
+car_state = {}
+# Reverse index of the cars each driver currently has out, kept in step with car_state:
+# driver -> {normalized plate: plate as logged}
+driver_cars = defaultdict(dict)
+
+def normalize_plate(plate):
+    return str(plate).strip().upper()
+
+def update_car_state(car, action, driver, ts):
+    plate = normalize_plate(car)
+    previous = car_state.get(plate)
+    if previous and previous[0] == "out":
+        driver_cars[previous[1]].pop(plate, None)
+    car_state[plate] = (action, driver, ts)
+    if action == "out":
+        driver_cars[driver][plate] = car
+
+# Yield raw Log rows as (timestamp, driver, plate, action) tuples, padding rows
+# whose trailing cells are empty and skipping blank rows
+def iter_log_rows(rows):
+    for row in rows:
+        if row:
+            yield tuple((row + [""] * 4)[:4])
+
+def load_car_state(log_rows):
+    car_state.clear()
+    driver_cars.clear()
+    # The Log worksheet is append-only, so rows are already in chronological order
+    for ts, driver, plate, action in iter_log_rows(log_rows):
+        if plate:
+            update_car_state(plate, action, driver, ts)
+    logger.debug("Car state loaded: %s", car_state)
+
+# car_state is loaded with the Sheets initialization, so callers await ensure_sheets() first
+def is_car_out(car):
+    return car_state.get(normalize_plate(car), ("in", "", ""))[0] == "out"
+
+# Plates are returned as logged on take, so the return row matches the take row
+def cars_held_by(driver):
+    return sorted(driver_cars.get(driver, {}).values())
+
+# Number of populated rows in the Log worksheet (header included), kept current on
+# every append so history can fetch just the tail instead of the whole log
+_log_rows = {"count": 1}
+
+# Short-lived cache of the Log data rows for searches; expired whenever log_writer appends.
+# Alongside the rows it keeps their timestamps when they are in order (the bot only ever
+# appends), so a day's rows can be found by bisection; None if the sheet was reordered.
+LOG_CACHE_TTL = int(os.getenv("LOG_CACHE_TTL", "60"))  # seconds
+_log_cache = {"rows": [], "timestamps": None, "expires": 0, "generation": 0}
+
+async def get_log_rows() -> tuple[list[tuple], list[str] | None]:
+    await ensure_sheets()
+    now = time.monotonic()
+    if now > _log_cache["expires"]:
+        generation = _log_cache["generation"]
+        rows = list(iter_log_rows((await sheet_call(sheet_log.get_all_values))[1:]))  # Skip header
+        timestamps = [row[0] for row in rows]
+        if not all(a <= b for a, b in zip(timestamps, timestamps[1:])):
+            timestamps = None
+        if _log_cache["generation"] != generation:
+            # Rows were appended while this read was in flight; answer this call from it,
+            # but leave the cache expired so the next search reads them
+            return rows, timestamps
+        _log_cache.update(rows=rows, timestamps=timestamps, expires=now + LOG_CACHE_TTL)
+    return _log_cache["rows"], _log_cache["timestamps"]
+
+# Only quota (429) and server-side (5xx) API errors, timeouts and dropped connections are
+# worth retrying; anything else (bad range, revoked access) fails the same way every time
+def is_retryable(e):
+    if isinstance(e, gspread.exceptions.APIError):
+        status = e.response.status_code if e.response is not None else None
+        return status is None or status == 429 or status >= 500
+    return isinstance(e, requests.exceptions.RequestException)
+
+# Background writes retry with backoff, but give up on permanent errors and after
+# SHEETS_WRITE_MAX_ATTEMPTS, so one bad write can't stall the writer or hang shutdown
+SHEETS_WRITE_MAX_ATTEMPTS = int(os.getenv("SHEETS_WRITE_MAX_ATTEMPTS", "5"))
+
+async def write_with_retry(write):
+    # write is called in a worker thread once Sheets is initialized
+    attempt = 1
+    while True:
+        try:
+            await ensure_sheets()
+            return await sheet_call(write)
+        except Exception as e:
+            if not is_retryable(e) or attempt == SHEETS_WRITE_MAX_ATTEMPTS:
+                raise
+            wait = min(2 ** attempt, 60)
+            logger.warning("Sheets write failed, retrying in %ss: %s", wait, e)
+            await asyncio.sleep(wait)
+            attempt += 1
+
+# Tell the admin chat about data that could not be saved, so it can be entered by hand
+async def report_unsaved(bot, text):
+    try:
+        await bot.send_message(chat_id=ADMIN_CHAT_ID, text=text)
+    except Exception as e:
+        logger.error("Failed to notify admin chat of unsaved data: %s", e)
+
+# Log rows are queued by handlers and written in batches by log_writer(), so a burst
+# of take/return actions costs one append_rows request instead of one write per row
+LOG_FLUSH_INTERVAL = 0.5  # seconds
+LOG_FLUSH_MAX_ROWS = 20
+log_queue = asyncio.Queue()
+
+async def write_log_rows(bot, batch):
+    try:
+        await write_with_retry(lambda: sheet_log.append_rows(batch, **APPEND_OPTIONS))
+    except asyncio.CancelledError:
+        logger.error("Log write cancelled; unsaved rows: %s", batch)
+        raise
+    except Exception as e:
+        # car_state and the users' confirmations already reflect these rows, so make sure
+        # they aren't lost silently
+        logger.error("Giving up on writing %s log rows: %s; unsaved rows: %s", len(batch), e, batch)
+        rows_text = "\n".join(", ".join(row) for row in batch)
+        await report_unsaved(bot, f"⚠️ Could not save {len(batch)} take/return records to the {LOG_WORKSHEET_NAME} worksheet. Please add them by hand:\n{rows_text}")
+        return
+    _log_rows["count"] += len(batch)
+    _log_cache.update(expires=0, generation=_log_cache["generation"] + 1)
+    logger.debug("Wrote %s log rows", len(batch))
+
+# Runs until a None sentinel is queued, writing whatever it has collected before exiting
+async def log_writer(bot):
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        row = await log_queue.get()
+        if row is None:
+            break
+        batch = [row]
+        deadline = loop.time() + LOG_FLUSH_INTERVAL
+        while len(batch) < LOG_FLUSH_MAX_ROWS:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(log_queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                stopping = True
+                break
+            batch.append(row)
+        await write_log_rows(bot, batch)
+
+# Drivers rows written in the background after approval; references are kept so the
+# tasks aren't garbage-collected mid-write and can be awaited on shutdown
+_driver_writes = set()
+
+async def write_driver_row(bot, row):
+    try:
+        await write_with_retry(lambda: sheet_drivers.append_row(row, **APPEND_OPTIONS))
+        logger.debug("Wrote driver row %s", row)
+    except asyncio.CancelledError:
+        logger.error("Driver write cancelled; unsaved row: %s", row)
+        raise
+    except Exception as e:
+        # The cached ID keeps the driver in only until the next cache refresh
+        logger.error("Giving up on writing driver row %s: %s", row, e)
+        await report_unsaved(bot, f"⚠️ Could not save approved driver {row[0]} (ID: {row[1]}) to the {DRIVERS_WORKSHEET_NAME} worksheet. Please add them by hand, or they will lose access within {DRIVERS_CACHE_TTL}s.")
+        return
+    try:
+        await get_driver_ids(force=True)
+    except Exception as e:
+        logger.error("Failed to refresh driver IDs after writing %s: %s", row, e)
+
+def queue_driver_row(bot, name, user_id):
+    cache_driver_id(str(user_id))
+    task = asyncio.create_task(write_driver_row(bot, [name, str(user_id)]))
+    _driver_writes.add(task)
+    task.add_done_callback(_driver_writes.discard)
+
+# The service account's OAuth token lasts an hour, and google-auth only renews it within a
+# few minutes of expiry, on whichever request comes next. Renew it in the background just
+# before that window instead, so no user action waits for the token endpoint.
+SHEETS_TOKEN_REFRESH_MARGIN = 5 * 60  # seconds before expiry; wider than google-auth's window
+SHEETS_TOKEN_RETRY_INTERVAL = 60  # seconds
+
+async def keep_sheets_warm():
+    while True:
+        try:
+            await ensure_sheets()
+            # gspread's authorized session holds the google-auth credentials it converted ours to
+            creds = sheet_log.client.session.credentials
+            if creds.expiry:
+                now = datetime.now(timezone.utc).replace(tzinfo=None)  # google-auth expiry is naive UTC
+                await asyncio.sleep(max((creds.expiry - now).total_seconds() - SHEETS_TOKEN_REFRESH_MARGIN, 0))
+            await sheet_call(creds.refresh, google.auth.transport.requests.Request())
+            logger.debug("Sheets token refreshed; valid until %s", creds.expiry)
+        except Exception as e:
+            logger.warning("Sheets token refresh failed: %s", e)
+            await asyncio.sleep(SHEETS_TOKEN_RETRY_INTERVAL)
+
+# The set of available cars changes slowly, so reuse the built keyboard between taps
+@functools.lru_cache(maxsize=8)
+def take_car_keyboard(cars):
+    return InlineKeyboardMarkup([[InlineKeyboardButton(f"{c} (Available)", callback_data=f"take|{c}")] for c in cars])
+
+# Callback data is "<action>|<payload>"; the payload may itself contain "|"
+def parse_callback(data):
+    action, _, payload = (data or "").partition("|")
+    if not action:
+        raise ValueError(f"Malformed callback data: {data!r}")
+    return action, payload
 
-# Define UAE time zone (UTC+4)
-UAE_TZ = pytz.timezone("Asia/Dubai")
+# Send independent Telegram requests concurrently; one failing doesn't cancel the others
+async def send_all(*coros):
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Failed to send Telegram message: %s", result)
+    return results
+
+# Report a failed update to the user, whether it came from a message or a button press
+async def reply_error(update, text):
+    try:
+        if update.callback_query:
+            await update.callback_query.edit_message_text(text)
+        else:
+            await update.message.reply_text(text)
+    except Exception as e:
+        logger.error("Failed to send error reply: %s", e)
 
 # Retry decorator for Google Sheets operations
-def retry_gsheet_operation(max_attempts=3, backoff_factor=2):
+SHEETS_MAX_ATTEMPTS = int(os.getenv("SHEETS_MAX_ATTEMPTS", "3"))
+# How long a Telegram request may wait for a free connection under bursts
+TELEGRAM_POOL_TIMEOUT = 30.0  # seconds
+# Cap on a whole handler attempt: long enough for a connection-pool wait plus a few Sheets
+# requests, so those narrower timeouts fire first
+HANDLER_TIMEOUT = TELEGRAM_POOL_TIMEOUT + 3 * SHEETS_TIMEOUT  # seconds
+
+def retry_gsheet_operation(error_message, max_attempts=SHEETS_MAX_ATTEMPTS, backoff_factor=2, timeout=HANDLER_TIMEOUT):
     def decorator(func):
         async def wrapper(*args, **kwargs):
             attempt = 1
             while attempt <= max_attempts:
                 try:
-                    return await func(*args, **kwargs)
+                    # Bound each attempt. This only cancels the handler: a Sheets request already
+                    # running in a worker thread is cut off by SHEETS_TIMEOUT instead.
+                    return await asyncio.wait_for(func(*args, **kwargs), timeout=timeout)
+                except asyncio.CancelledError:
+                    logger.debug("%s cancelled; not retrying", func.__name__)
+                    raise
+                except asyncio.TimeoutError:
+                    logger.error("%s timed out after %ss; not retrying", func.__name__, timeout)
+                    # The handler was cancelled before it could reply, so answer for it
+                    await reply_error(args[0], error_message)
+                    raise
                 except gspread.exceptions.APIError as e:
+                    if not is_retryable(e):
+                        logger.error("API error in %s; not retrying: %s", func.__name__, e)
+                        raise
                     if attempt == max_attempts:
-                        logger.error(f"Failed after {max_attempts} attempts: {e}")
+                        logger.error("Failed after %s attempts: %s", max_attempts, e)
                         raise
                     wait = backoff_factor ** attempt
-                    logger.warning(f"API error, retrying after {wait}s: {e}")
-                    time.sleep(wait)
+                    # Prefer the server-provided delay on 429 responses
+                    retry_after = e.response.headers.get("Retry-After") if e.response is not None else None
+                    if retry_after and retry_after.isdigit():
+                        wait = int(retry_after)
+                    # Add jitter so concurrent handlers don't retry in lockstep
+                    wait += random.uniform(0, wait * 0.25)
+                    logger.warning("API error, retrying after %.1fs: %s", wait, e)
+                    await asyncio.sleep(wait)
                     attempt += 1
                 except Exception as e:
-                    logger.error(f"Unexpected error in {func.__name__}: {e}")
+                    logger.error("Unexpected error in %s: %s", func.__name__, e)
                     raise
             return None
         return wrapper
@@ -142,21 +570,21 @@ def admin_or_driver(func):
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         try:
-            driver_ids = sheet_drivers.col_values(2)[1:]
+            driver_ids = await get_driver_ids()
         except gspread.exceptions.WorksheetNotFound:
-            logger.error(f"Drivers worksheet '{DRIVERS_WORKSHEET_NAME}' not found")
+            logger.error("Drivers worksheet '%s' not found", DRIVERS_WORKSHEET_NAME)
             await update.message.reply_text(f"❌ Error: Drivers worksheet '{DRIVERS_WORKSHEET_NAME}' not found in Google Sheets.")
             return
         except Exception as e:
-            logger.error(f"Error fetching driver IDs: {e}")
+            logger.error("Error fetching driver IDs: %s", e)
             await update.message.reply_text("❌ Server error. Please try again later.")
             return
         # Corrected logic: Deny access only if user is neither an admin nor a driver
         if user_id not in ADMINS and str(user_id) not in driver_ids:
-            logger.debug(f"User {user_id} denied access (not in ADMINS: {user_id not in ADMINS}, not in driver_ids: {str(user_id) not in driver_ids})")
+            logger.debug("User %s denied access (not in ADMINS: %s, not in driver_ids: %s)", user_id, user_id not in ADMINS, str(user_id) not in driver_ids)
             await update.message.reply_text("❌ Access denied. You are not registered.")
             return
-        logger.debug(f"User {user_id} granted access (in ADMINS: {user_id in ADMINS}, in driver_ids: {str(user_id) in driver_ids})")
+        logger.debug("User %s granted access (in ADMINS: %s, in driver_ids: %s)", user_id, user_id in ADMINS, str(user_id) in driver_ids)
         return await func(update, context)
     return wrapper
 
@@ -164,23 +592,22 @@ def admin_or_driver(func):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     try:
-        driver_ids = sheet_drivers.col_values(2)[1:]
-        logger.debug(f"Driver IDs fetched: {driver_ids}")
+        driver_ids = await get_driver_ids()
+        logger.debug("Driver IDs fetched: %s", driver_ids)
     except gspread.exceptions.WorksheetNotFound:
-        logger.error(f"Drivers worksheet '{DRIVERS_WORKSHEET_NAME}' not found in start handler")
+        logger.error("Drivers worksheet '%s' not found in start handler", DRIVERS_WORKSHEET_NAME)
         await update.message.reply_text(f"❌ Error: Drivers worksheet '{DRIVERS_WORKSHEET_NAME}' not found in Google Sheets.")
         return
     except Exception as e:
-        logger.error(f"Error in start handler: {e}")
+        logger.error("Error in start handler: %s", e)
         await update.message.reply_text("❌ Server error. Please try again later.")
         return
     if user_id in ADMINS or str(user_id) in driver_ids:
-        logger.debug(f"User {user_id} is authorized (admin: {user_id in ADMINS}, driver: {str(user_id) in driver_ids})")
-        # Admins get the combined menu, drivers get the main menu
-        menu = COMBINED_MENU if user_id in ADMINS else MAIN_MENU
+        logger.debug("User %s is authorized (admin: %s, driver: %s)", user_id, user_id in ADMINS, str(user_id) in driver_ids)
+        menu = menu_for(user_id)
         await update.message.reply_text("Welcome! Choose an option:", reply_markup=menu)
     else:
-        logger.debug(f"User {user_id} is not authorized. Sending access request.")
+        logger.debug("User %s is not authorized. Sending access request.", user_id)
         await update.message.reply_text("❌ Access denied. Requesting access from admin...")
         buttons = InlineKeyboardMarkup([
             [
@@ -200,7 +627,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=buttons
             )
         except Exception as e:
-            logger.error(f"Error sending access request: {e}")
+            logger.error("Error sending access request: %s", e)
             await update.message.reply_text("❌ Failed to send access request. Please try again.")
 
 @admin_only
@@ -215,17 +642,13 @@ async def add_car_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @admin_only
 async def remove_car_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        all_cars = sheet_cars.col_values(1)[1:]  # Skip header
+        all_cars = await get_cars()
         if not all_cars:
             return await update.message.reply_text("🚫 No cars available to remove.", reply_markup=ADMIN_MENU)
         
-        # Check which cars are in use
-        logs = sheet_log.get_all_records()
-        last_action = {r["Car Plate"]: r["Action"] for r in logs}
-        
         buttons = []
-        for car in all_cars:
-            if last_action.get(car) == "out":
+        for car in all_cars.values():
+            if is_car_out(car):
                 # Car is in use, show without remove button
                 buttons.append([InlineKeyboardButton(f"{car} (In Use)", callback_data="noop")])
             else:
@@ -234,7 +657,7 @@ async def remove_car_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         await update.message.reply_text("Select a car to remove (cars in use cannot be removed):", reply_markup=InlineKeyboardMarkup(buttons))
     except Exception as e:
-        logger.error(f"Error in remove_car_prompt: {e}")
+        logger.error("Error in remove_car_prompt: %s", e)
         await update.message.reply_text("❌ Error fetching cars to remove. Please try again.", reply_markup=ADMIN_MENU)
 
 @admin_only
@@ -242,12 +665,13 @@ async def add_driver_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["await"] = "add_driver"
     await update.message.reply_text("➕ Send the DRIVER NAME and TELEGRAM USER ID (comma-separated, e.g., John Doe, 123456789):", reply_markup=ADMIN_MENU)
 
-@retry_gsheet_operation()
+@retry_gsheet_operation("❌ Error fetching driver list. Please try again or contact the admin.")
 @admin_only
 async def driver_list_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        # Fetch all data as a list of lists to validate structure
-        driver_data = sheet_drivers.get_all_values()
+        await ensure_sheets()
+        # Fetch all rows as a list of lists
+        driver_data = await sheet_call(sheet_drivers.get_all_values)
         if not driver_data:
             buttons = [[InlineKeyboardButton("➕ Add Driver", callback_data="add_driver")]]
             return await update.message.reply_text(
@@ -255,19 +679,10 @@ async def driver_list_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=InlineKeyboardMarkup(buttons)
             )
         
-        # Check for headers
-        if len(driver_data) < 1 or not driver_data[0]:
-            return await update.message.reply_text("❌ Error: Drivers worksheet is empty or missing headers. Expected headers: 'Name', 'User ID'.", reply_markup=ADMIN_MENU)
-        
-        headers = driver_data[0]
-        if "Name" not in headers or "User ID" not in headers:
-            return await update.message.reply_text("❌ Error: Drivers worksheet missing required headers. Expected: 'Name', 'User ID'.", reply_markup=ADMIN_MENU)
-        
-        # Fetch records using get_all_records
-        drivers = sheet_drivers.get_all_records()
+        # Headers are validated at startup; rows are positional: Name, User ID
         buttons = [
-            [InlineKeyboardButton(f"{d['Name']} (ID: {d['User ID']}) - Remove", callback_data=f"remove_driver|{d['Name']}")]
-            for d in drivers
+            [InlineKeyboardButton(f"{name} (ID: {uid}) - Remove", callback_data=f"remove_driver|{name}")]
+            for name, uid in ((row + ["", ""])[:2] for row in driver_data[1:])
         ]
         # Add the "Add Driver" button
         buttons.append([InlineKeyboardButton("➕ Add Driver", callback_data="add_driver")])
@@ -277,89 +692,70 @@ async def driver_list_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=InlineKeyboardMarkup(buttons)
         )
     except gspread.exceptions.WorksheetNotFound:
-        logger.error(f"Drivers worksheet '{DRIVERS_WORKSHEET_NAME}' not found")
+        logger.error("Drivers worksheet '%s' not found", DRIVERS_WORKSHEET_NAME)
         await update.message.reply_text(f"❌ Error: Drivers worksheet '{DRIVERS_WORKSHEET_NAME}' not found in Google Sheets. Please check the spreadsheet configuration.", reply_markup=ADMIN_MENU)
     except gspread.exceptions.APIError as e:
         error_details = e.response.json() if hasattr(e.response, 'json') else str(e)
-        logger.error(f"Google Sheets API error: {error_details}")
+        logger.error("Google Sheets API error: %s", error_details)
         if "quota" in error_details.lower():
             await update.message.reply_text("❌ Error: Google Sheets API quota exceeded. Please try again later or contact the admin.", reply_markup=ADMIN_MENU)
         else:
             await update.message.reply_text("❌ Error fetching driver list due to API issue. Please try again later.", reply_markup=ADMIN_MENU)
     except ValueError as e:
-        logger.error(f"ValueError in driver_list_menu: {e}")
+        logger.error("ValueError in driver_list_menu: %s", e)
         await update.message.reply_text("❌ Error: Drivers worksheet data is malformed. Ensure it has proper headers ('Name', 'User ID') and data rows.", reply_markup=ADMIN_MENU)
     except Exception as e:
-        logger.error(f"Unexpected error in driver_list_menu: {e}")
+        logger.error("Unexpected error in driver_list_menu: %s", e)
         await update.message.reply_text("❌ Error fetching driver list. Please try again or contact the admin.", reply_markup=ADMIN_MENU)
 
-@retry_gsheet_operation()
+@retry_gsheet_operation("❌ Error fetching status. Please try again.")
 @admin_only
 async def status_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        logs = sheet_log.get_all_records()
-        # Sort logs by timestamp to ensure the most recent action is last
-        logs.sort(key=lambda x: x["Timestamp"])
-        # Normalize car plates and build last_action dictionary with driver info
-        last = {}
-        car_driver = {}  # Track which driver has each car
-        for r in logs:
-            car_plate = str(r["Car Plate"]).strip().upper()
-            last[car_plate] = r["Action"]
-            if r["Action"] == "out":
-                car_driver[car_plate] = r["Driver Name"]
-        logger.debug(f"Raw Log data: {logs}")
-        logger.debug(f"Last actions for cars in status_menu: {last}")
-        logger.debug(f"Car to driver mapping in status_menu: {car_driver}")
-        
-        all_cars = sheet_cars.col_values(1)[1:]
-        logger.debug(f"Raw Cars data: {all_cars}")
+        # Plates are cached normalized, matching the car_state keys
+        normalized_to_display = await get_cars()
         status_lines = []
-        for car in all_cars:
-            normalized_car = str(car).strip().upper()
-            state = last.get(normalized_car, "✅ Available")
-            if state == "out":
-                driver = car_driver.get(normalized_car, "Unknown")
+        for normalized_car, car in normalized_to_display.items():
+            action, driver, _ = car_state.get(normalized_car, ("in", "", ""))
+            if action == "out":
+                driver = driver or "Unknown"
                 label = f"❌ Out (Driver: {driver})"
             else:
                 label = "✅ Available"
             status_lines.append(f"{label} — {car}")
-            logger.debug(f"Car {car} (normalized: {normalized_car}) status: {label}")
+            logger.debug("Car %s (normalized: %s) status: %s", car, normalized_car, label)
         
         status_text = "\n".join(status_lines) or "No cars found."
         await update.message.reply_text(f"📊 Current Car Status:\n\n{status_text}", reply_markup=ADMIN_MENU)
     except Exception as e:
-        logger.error(f"Error in status_menu: {e}")
+        logger.error("Error in status_menu: %s", e)
         await update.message.reply_text("❌ Error fetching status. Please try again.", reply_markup=ADMIN_MENU)
 
-@retry_gsheet_operation()
+@retry_gsheet_operation("❌ Error fetching history. Please try again or contact the admin.")
 @admin_only
 async def history_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        # Fetch all data as a list of lists to validate structure
-        log_data = sheet_log.get_all_values()
-        if not log_data:
-            return await update.message.reply_text("🔍 No history records found (worksheet is empty).", reply_markup=ADMIN_MENU)
+        await ensure_sheets()  # Sets the Log row count used below
+        # Fetch only the tail of the log; the open-ended range still picks up rows
+        # added outside the bot since the row count was last updated
+        start_row = max(2, _log_rows["count"] - 9)
+        log_data = await sheet_call(sheet_log.get, f"A{start_row}:D")
+        if len(log_data) < 10 and start_row > 2:
+            # Fewer rows than expected: rows were deleted by hand and the count overshoots.
+            # Read the whole log once and resync the count.
+            log_data = await sheet_call(sheet_log.get, "A2:D")
+            _log_rows["count"] = len(log_data) + 1
         
-        # Check for headers
-        if len(log_data) < 1 or not log_data[0]:
-            return await update.message.reply_text("❌ Error: Log worksheet is empty or missing headers. Expected headers: 'Timestamp', 'Driver Name', 'Car Plate', 'Action'.", reply_markup=ADMIN_MENU)
-        
-        headers = log_data[0]
-        required_headers = ["Timestamp", "Driver Name", "Car Plate", "Action"]
-        if not all(h in headers for h in required_headers):
-            return await update.message.reply_text("❌ Error: Log worksheet missing required headers. Expected: 'Timestamp', 'Driver Name', 'Car Plate', 'Action'.", reply_markup=ADMIN_MENU)
-        
-        # Fetch records using get_all_records
-        logs = sheet_log.get_all_records()
+        # Headers are validated at startup; rows are positional: Timestamp, Driver Name, Car Plate, Action
+        logs = list(iter_log_rows(log_data))
         if not logs:
             return await update.message.reply_text("🔍 No history records found (no data rows).", reply_markup=ADMIN_MENU)
         
         # Show the latest 10 entries with the new timestamp format
         latest = logs[-10:]
         lines = [
-            f'{datetime.strptime(r["Timestamp"], "%Y-%m-%d %H:%M").astimezone(UAE_TZ).strftime("%d-%m-%Y, %I:%M %p")} - {r["Driver Name"]} {"took" if r["Action"] == "out" else "returned"} {r["Car Plate"]}'
-            for r in latest
+            f'{display_ts(ts)} - {driver} {"took" if action == "out" else "returned"} {plate}'
+            for ts, driver, plate, action in latest
         ]
         await update.message.reply_text("🔍 Latest History:\n\n" + "\n".join(lines), reply_markup=ADMIN_MENU)
         
@@ -371,230 +767,230 @@ async def history_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=ADMIN_MENU
         )
     except gspread.exceptions.WorksheetNotFound:
-        logger.error(f"Log worksheet '{LOG_WORKSHEET_NAME}' not found")
+        logger.error("Log worksheet '%s' not found", LOG_WORKSHEET_NAME)
         await update.message.reply_text(f"❌ Error: Log worksheet '{LOG_WORKSHEET_NAME}' not found in Google Sheets. Please check the spreadsheet configuration.", reply_markup=ADMIN_MENU)
     except gspread.exceptions.APIError as e:
         error_details = e.response.json() if hasattr(e.response, 'json') else str(e)
-        logger.error(f"Google Sheets API error: {error_details}")
+        logger.error("Google Sheets API error: %s", error_details)
         if "quota" in error_details.lower():
             await update.message.reply_text("❌ Error: Google Sheets API quota exceeded. Please try again later or contact the admin.", reply_markup=ADMIN_MENU)
         else:
             await update.message.reply_text("❌ Error fetching history due to API issue. Please try again later.", reply_markup=ADMIN_MENU)
     except ValueError as e:
-        logger.error(f"ValueError in history_menu: {e}")
+        logger.error("ValueError in history_menu: %s", e)
         await update.message.reply_text("❌ Error: Log worksheet data is malformed. Ensure it has proper headers ('Timestamp', 'Driver Name', 'Car Plate', 'Action') and data rows.", reply_markup=ADMIN_MENU)
     except Exception as e:
-        logger.error(f"Error in history_menu: {e}")
+        logger.error("Error in history_menu: %s", e)
         await update.message.reply_text("❌ Error fetching history. Please try again or contact the admin.", reply_markup=ADMIN_MENU)
 
 async def back_to_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.debug(f"Back to main menu triggered by user {update.effective_user.id}")
+    logger.debug("Back to main menu triggered by user %s", update.effective_user.id)
     user_id = update.effective_user.id
     try:
-        driver_ids = sheet_drivers.col_values(2)[1:]
+        driver_ids = await get_driver_ids()
     except gspread.exceptions.WorksheetNotFound:
-        logger.error(f"Drivers worksheet '{DRIVERS_WORKSHEET_NAME}' not found")
+        logger.error("Drivers worksheet '%s' not found", DRIVERS_WORKSHEET_NAME)
         await update.message.reply_text(f"❌ Error: Drivers worksheet '{DRIVERS_WORKSHEET_NAME}' not found in Google Sheets.")
         return
     except Exception as e:
-        logger.error(f"Error fetching driver IDs in back_to_main_menu: {e}")
+        logger.error("Error fetching driver IDs in back_to_main_menu: %s", e)
         await update.message.reply_text("❌ Server error. Please try again later.")
         return
-    # Show COMBINED_MENU for admins, MAIN_MENU for drivers
-    menu = COMBINED_MENU if user_id in ADMINS else MAIN_MENU
+    menu = menu_for(user_id)
     await update.message.reply_text("🔙 Back to main menu:", reply_markup=menu)
 
-@retry_gsheet_operation()
+@retry_gsheet_operation("❌ Error fetching available cars. Please try again.")
 @admin_or_driver
 async def take_car_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user.first_name
+    user_id = update.effective_user.id
+    menu = menu_for(user_id)
     try:
-        user = update.effective_user.first_name
-        user_id = update.effective_user.id
-        # Fetch and sort logs
-        logs = sheet_log.get_all_records()
-        logs.sort(key=lambda x: x["Timestamp"])
-        logger.debug(f"Raw Log data in take_car_menu: {logs}")
-        
-        # Build last_action dictionary with driver info
-        last_action = {}
-        car_driver = {}  # Track which driver has each car
-        for r in logs:
-            car_plate = str(r["Car Plate"]).strip().upper()
-            last_action[car_plate] = r["Action"]
-            if r["Action"] == "out":
-                car_driver[car_plate] = r["Driver Name"]
-        logger.debug(f"Last actions for cars: {last_action}")
-        logger.debug(f"Car to driver mapping: {car_driver}")
-        
+        await ensure_sheets()  # Loads car_state
         # Check if the current driver already has a car
-        user_cars = [cp for cp, action in last_action.items() if action == "out" and car_driver.get(cp) == user]
-        logger.debug(f"Driver {user} has cars: {user_cars}")
+        user_cars = cars_held_by(user)
+        logger.debug("Driver %s has cars: %s", user, user_cars)
         if user_cars:
-            menu = COMBINED_MENU if user_id in ADMINS else MAIN_MENU
             return await update.message.reply_text(f"🚫 You already have a car ({user_cars[0]}). Please return it before taking another.", reply_markup=menu)
         
-        all_cars = sheet_cars.col_values(1)[1:]  # Skip header
-        if not all_cars:
-            menu = COMBINED_MENU if user_id in ADMINS else MAIN_MENU
+        normalized_to_display = await get_cars()
+        if not normalized_to_display:
             return await update.message.reply_text("🚫 No cars available in the system.", reply_markup=menu)
         
-        # Filter only available cars
-        available_cars = [car for car in all_cars if last_action.get(str(car).strip().upper()) != "out"]
+        # Filter only available cars, straight into the hashable key the keyboard cache needs
+        available_cars = tuple(
+            car for norm, car in normalized_to_display.items()
+            if car_state.get(norm, ("in", "", ""))[0] != "out"
+        )
         if not available_cars:
-            menu = COMBINED_MENU if user_id in ADMINS else MAIN_MENU
             return await update.message.reply_text("🚫 No cars available to take right now.", reply_markup=menu)
         
-        buttons = []
-        for car in available_cars:
-            buttons.append([InlineKeyboardButton(f"{car} (Available)", callback_data=f"take|{car}")])
-            logger.debug(f"Car {car} (normalized: {str(car).strip().upper()}) is available.")
-        
-        await update.message.reply_text("Select a car to take:", reply_markup=InlineKeyboardMarkup(buttons))
+        logger.debug("Available cars: %s", available_cars)
+        keyboard = take_car_keyboard(available_cars)
+        await update.message.reply_text("Select a car to take:", reply_markup=keyboard)
     except Exception as e:
-        logger.error(f"Error in take_car_menu: {e}")
-        menu = COMBINED_MENU if user_id in ADMINS else MAIN_MENU
+        logger.error("Error in take_car_menu: %s", e)
         await update.message.reply_text("❌ Error fetching available cars. Please try again.", reply_markup=menu)
 
-@retry_gsheet_operation()
+@retry_gsheet_operation("❌ Error fetching cars to return. Please try again.")
 @admin_or_driver
 async def return_car_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user.first_name
+    user_id = update.effective_user.id
+    menu = menu_for(user_id)
     try:
-        user = update.effective_user.first_name
-        user_id = update.effective_user.id
-        logs = sheet_log.get_all_records()
-        last = {r["Car Plate"]: r for r in logs}
-        user_cars = [cp for cp, rec in last.items() if rec["Action"] == "out" and rec["Driver Name"] == user]
+        await ensure_sheets()  # Loads car_state
+        user_cars = cars_held_by(user)
         if not user_cars:
-            menu = COMBINED_MENU if user_id in ADMINS else MAIN_MENU
             return await update.message.reply_text("✅ You have no cars to return.", reply_markup=menu)
         buttons = [[InlineKeyboardButton(c, callback_data=f"return|{c}")] for c in user_cars]
         await update.message.reply_text("Select a car to return:", reply_markup=InlineKeyboardMarkup(buttons))
     except Exception as e:
-        logger.error(f"Error in return_car_menu: {e}")
-        menu = COMBINED_MENU if user_id in ADMINS else MAIN_MENU
+        logger.error("Error in return_car_menu: %s", e)
         await update.message.reply_text("❌ Error fetching cars to return. Please try again.", reply_markup=menu)
 
-@retry_gsheet_operation()
+@retry_gsheet_operation("❌ Error processing request.")
 async def handle_access_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     try:
-        action, user_id, *user_name_parts = query.data.split("|")
+        action, payload = parse_callback(query.data)
+        user_id, _, user_name = payload.partition("|")
         user_id = int(user_id)
-        user_name = user_name_parts[0] if user_name_parts else "Unknown"
+        user_name = user_name or "Unknown"
         if action == "approve":
-            # Add the new driver to the Drivers worksheet
-            sheet_drivers.append_row([user_name, str(user_id)])
-            await query.edit_message_text(f"✅ Access approved for {user_name} (ID: {user_id})")
-            await context.bot.send_message(user_id, "✅ Your access request was approved! You are now a driver.", reply_markup=MAIN_MENU)
-            # Send notification to admin chat
-            await context.bot.send_message(
-                chat_id=ADMIN_CHAT_ID,
-                text=f"✅ New driver {user_name} (ID: {user_id}) has been approved."
+            # Grant access right away; the Drivers worksheet row is written in the background
+            queue_driver_row(context.bot, user_name, user_id)
+            await send_all(
+                query.edit_message_text(f"✅ Access approved for {user_name} (ID: {user_id})"),
+                context.bot.send_message(user_id, "✅ Your access request was approved! You are now a driver.", reply_markup=MAIN_MENU),
+                # Send notification to admin chat
+                context.bot.send_message(
+                    chat_id=ADMIN_CHAT_ID,
+                    text=f"✅ New driver {user_name} (ID: {user_id}) has been approved."
+                ),
             )
         else:
-            await query.edit_message_text(f"❌ Access rejected for {user_name} (ID: {user_id})")
-            await context.bot.send_message(user_id, "❌ Your access request was rejected.")
+            await send_all(
+                query.edit_message_text(f"❌ Access rejected for {user_name} (ID: {user_id})"),
+                context.bot.send_message(user_id, "❌ Your access request was rejected."),
+            )
     except Exception as e:
-        logger.error(f"Error in handle_access_request: {e}")
+        logger.error("Error in handle_access_request: %s", e)
         await query.edit_message_text("❌ Error processing request.")
 
-@retry_gsheet_operation()
+@retry_gsheet_operation("❌ Error processing driver action. Please try again or contact the admin.")
 async def handle_driver_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     try:
-        action, *params = query.data.split("|")
+        action, driver_name = parse_callback(query.data)
         if action == "remove_driver":
-            driver_name = params[0]
-            # Fetch the first column (driver names)
-            driver_data = sheet_drivers.get_all_values()
-            if len(driver_data) <= 1:  # Only headers or empty
-                await query.edit_message_text("⚠️ No drivers to remove.")
-                return
-            vals = sheet_drivers.col_values(1)[1:]  # Skip header
-            if not vals or driver_name not in vals:
-                await query.edit_message_text(f"⚠️ Driver {driver_name} not found.")
-                return
-            # Find the row number (adding 1 to account for header)
-            row = vals.index(driver_name) + 2
-            sheet_drivers.delete_rows(row, row)  # Use delete_rows for single row
+            await ensure_sheets()
+            async with _drivers_sheet_lock:
+                # One read gives both the driver's row and the ID whose access is revoked. It is
+                # made under the lock, so the row found still holds this driver when it is deleted
+                # (a repeated tap finds nothing instead of deleting the row that moved up).
+                rows = [(row + ["", ""])[:2] for row in (await sheet_call(sheet_drivers.get_all_values))]
+                row_number = next((i for i, (name, _) in enumerate(rows[1:], start=2) if name == driver_name), None)
+                if row_number is None:
+                    await query.edit_message_text(f"⚠️ Driver {driver_name} not found.")
+                    return
+                await sheet_call(sheet_drivers.delete_rows, row_number, row_number)  # Use delete_rows for single row
+                removed_id = rows[row_number - 1][1]
+                # Keep the ID cached if another row still grants it
+                if all(uid != removed_id for i, (_, uid) in enumerate(rows[1:], start=2) if i != row_number):
+                    cache_driver_id(removed_id, present=False)
             await query.edit_message_text(f"✅ Driver {driver_name} removed.")
         elif action == "add_driver":
             await query.message.reply_text("➕ Send the DRIVER NAME and TELEGRAM USER ID (comma-separated, e.g., John Doe, 123456789):", reply_markup=ADMIN_MENU)
             context.user_data["await"] = "add_driver"
     except gspread.exceptions.WorksheetNotFound:
-        logger.error(f"Drivers worksheet '{DRIVERS_WORKSHEET_NAME}' not found")
+        logger.error("Drivers worksheet '%s' not found", DRIVERS_WORKSHEET_NAME)
         await query.edit_message_text(f"❌ Error: Drivers worksheet '{DRIVERS_WORKSHEET_NAME}' not found in Google Sheets.")
     except gspread.exceptions.APIError as e:
         error_details = e.response.json() if hasattr(e.response, 'json') else str(e)
-        logger.error(f"Google Sheets API error in handle_driver_action: {error_details}")
+        logger.error("Google Sheets API error in handle_driver_action: %s", error_details)
         if "quota" in error_details.lower():
             await query.edit_message_text("❌ Error: Google Sheets API quota exceeded. Please try again later.")
         else:
             await query.edit_message_text("❌ Error: Failed to process driver action due to API issue. Please try again later.")
     except ValueError as e:
-        logger.error(f"ValueError in handle_driver_action: {e}")
+        logger.error("ValueError in handle_driver_action: %s", e)
         await query.edit_message_text("❌ Error: Drivers worksheet data is malformed. Please check the worksheet.")
     except Exception as e:
-        logger.error(f"Unexpected error in handle_driver_action: {e}")
+        logger.error("Unexpected error in handle_driver_action: %s", e)
         await query.edit_message_text("❌ Error processing driver action. Please try again or contact the admin.")
 
-@retry_gsheet_operation()
+@retry_gsheet_operation("❌ Error removing car. Please try again or contact the admin.")
 async def handle_remove_car_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     try:
-        action, car_plate = query.data.split("|")
+        action, car_plate = parse_callback(query.data)
         if action != "remove_car":
             return
-        # Check if the car is in use
-        logs = sheet_log.get_all_records()
-        last_action = {r["Car Plate"]: r["Action"] for r in logs}
-        if last_action.get(car_plate) == "out":
-            await query.edit_message_text(f"⚠️ Car {car_plate} is currently in use. It can only be removed after being returned.")
-            return
-        # Fetch all car plates
-        all_cars = sheet_cars.col_values(1)
-        if car_plate not in all_cars:
-            await query.edit_message_text(f"⚠️ Car {car_plate} not found.")
-            return
-        # Find the row number (adding 1 to account for header)
-        row = all_cars.index(car_plate) + 1
-        sheet_cars.delete_rows(row, row)  # Use delete_rows for single row
+        await ensure_sheets()  # Loads car_state
+        async with _cars_sheet_lock:
+            # Locate the car's row in the plate column (row 1 is the header). The lookup is made
+            # under the lock, so the row found still holds this plate when it is deleted.
+            cell = await sheet_call(sheet_cars.find, car_plate, in_column=1)
+            if cell is None or cell.row == 1:
+                await query.edit_message_text(f"⚠️ Car {car_plate} not found.")
+                return
+            # Check if the car is in use, right before deleting so a take made meanwhile is seen
+            if is_car_out(car_plate):
+                await query.edit_message_text(f"⚠️ Car {car_plate} is currently in use. It can only be removed after being returned.")
+                return
+            await sheet_call(sheet_cars.delete_rows, cell.row, cell.row)  # Use delete_rows for single row
+            cache_car(car_plate, present=False)
         await query.edit_message_text(f"✅ Car {car_plate} removed.")
     except gspread.exceptions.WorksheetNotFound:
         logger.error("Cars worksheet not found")
         await query.edit_message_text("❌ Error: Cars worksheet not found in Google Sheets.")
     except gspread.exceptions.APIError as e:
         error_details = e.response.json() if hasattr(e.response, 'json') else str(e)
-        logger.error(f"Google Sheets API error in handle_remove_car_action: {error_details}")
+        logger.error("Google Sheets API error in handle_remove_car_action: %s", error_details)
         if "quota" in error_details.lower():
             await query.edit_message_text("❌ Error: Google Sheets API quota exceeded. Please try again later.")
         else:
             await query.edit_message_text("❌ Error: Failed to remove car due to API issue. Please try again later.")
     except ValueError as e:
-        logger.error(f"ValueError in handle_remove_car_action: {e}")
+        logger.error("ValueError in handle_remove_car_action: %s", e)
         await query.edit_message_text("❌ Error: Cars worksheet data is malformed. Please check the worksheet.")
     except Exception as e:
-        logger.error(f"Unexpected error in handle_remove_car_action: {e}")
+        logger.error("Unexpected error in handle_remove_car_action: %s", e)
         await query.edit_message_text("❌ Error removing car. Please try again or contact the admin.")
 
-@retry_gsheet_operation()
+# Admin text inputs, validated and split in one pass: "Name, TelegramUserID" and
+# "CAR_PLATE, DD-MM-YYYY"
+ADD_DRIVER_RE = re.compile(r"^(.+?)\s*,\s*(\d+)$")
+SEARCH_LOGS_RE = re.compile(r"^(.+?)\s*,\s*(\d{1,2})-(\d{1,2})-(\d{4})$")
+
+@retry_gsheet_operation("❌ An error occurred. Please try again.")
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     action = context.user_data.pop("await", None)
     text = update.message.text.strip()
     try:
         if action == "add_car":
-            existing = sheet_cars.col_values(1)[1:]
-            if text in existing:
-                return await update.message.reply_text("⚠️ That plate already exists.", reply_markup=ADMIN_MENU)
-            sheet_cars.append_row([text])
+            # Check and append under the lock so two adds of one plate can't both pass the check
+            async with _cars_sheet_lock:
+                cars = await get_cars()
+                if normalize_plate(text) in cars:
+                    return await update.message.reply_text("⚠️ That plate already exists.", reply_markup=ADMIN_MENU)
+                await sheet_call(sheet_cars.append_row, [text], **APPEND_OPTIONS)
+                cache_car(text)
             return await update.message.reply_text(f"✅ Car {text} added.", reply_markup=ADMIN_MENU)
         if action == "add_driver":
             try:
-                name, user_id = map(str.strip, text.split(","))
-                sheet_drivers.append_row([name, user_id])
+                match = ADD_DRIVER_RE.match(text)
+                if not match:
+                    raise ValueError(f"Malformed driver input: {text!r}")
+                name, user_id = match.groups()
+                await ensure_sheets()
+                await sheet_call(sheet_drivers.append_row, [name, user_id], **APPEND_OPTIONS)
+                # The row was just written, so update the cached IDs instead of re-reading the column
+                cache_driver_id(user_id)
                 await update.message.reply_text(f"✅ Driver {name} added with ID {user_id}.", reply_markup=ADMIN_MENU)
                 # Refresh the driver list
                 await driver_list_menu(update, context)
@@ -603,116 +999,219 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if action == "search_logs":
             try:
                 # Parse the input: expected format "CAR_PLATE, DD-MM-YYYY"
-                car_plate, date_str = map(str.strip, text.split(","))
+                match = SEARCH_LOGS_RE.match(text)
+                if not match:
+                    raise ValueError(f"Malformed search input: {text!r}")
+                car_plate, day, month, year = match.groups()
                 car_plate = car_plate.upper()
-                search_date = datetime.strptime(date_str, "%d-%m-%Y").date()
+                # Accepts unpadded days and months like strptime did; rejects dates like 31-02-2025
+                search_date = date(int(year), int(month), int(day))
+                date_str = search_date.strftime("%d-%m-%Y")
                 
-                # Fetch logs and filter by car plate and date
-                logs = sheet_log.get_all_records()
-                filtered_logs = [
-                    log for log in logs
-                    if log["Car Plate"].upper() == car_plate and
-                    datetime.strptime(log["Timestamp"], "%Y-%m-%d %H:%M").astimezone(UAE_TZ).date() == search_date
-                ]
+                # Stored timestamps are UAE local "YYYY-MM-DD HH:MM", so a date prefix
+                # match selects the day without parsing every row
+                date_prefix = search_date.isoformat()
+                
+                # Fetch logs and filter by date and car plate
+                # Rows are positional: Timestamp, Driver Name, Car Plate, Action
+                rows, timestamps = await get_log_rows()
+                if timestamps is not None:
+                    # Rows are in time order, so the day is one contiguous slice
+                    start = bisect.bisect_left(timestamps, date_prefix)
+                    end = bisect.bisect_left(timestamps, date_prefix + "\uffff", start)
+                    rows = rows[start:end]
+                filtered_logs = []
+                for ts, driver, plate, log_action in rows:
+                    if not ts.startswith(date_prefix) or plate.upper() != car_plate:
+                        continue
+                    # Format each matching timestamp once; bad ones are skipped rather than failing the search
+                    try:
+                        filtered_logs.append((display_ts(ts), driver, plate, log_action))
+                    except ValueError:
+                        logger.warning("Skipping log row with bad timestamp: %r", ts)
                 
                 if not filtered_logs:
                     return await update.message.reply_text(f"🔍 No records found for car {car_plate} on {date_str}.", reply_markup=ADMIN_MENU)
                 
                 # Format the filtered logs with the new timestamp format
                 lines = [
-                    f'{datetime.strptime(log["Timestamp"], "%Y-%m-%d %H:%M").astimezone(UAE_TZ).strftime("%d-%m-%Y, %I:%M %p")} - {log["Driver Name"]} {"took" if log["Action"] == "out" else "returned"} {log["Car Plate"]}'
-                    for log in filtered_logs
+                    f'{ts_text} - {driver} {"took" if log_action == "out" else "returned"} {plate}'
+                    for ts_text, driver, plate, log_action in filtered_logs
                 ]
                 await update.message.reply_text(f"🔍 Search Results for {car_plate} on {date_str}:\n\n" + "\n".join(lines), reply_markup=ADMIN_MENU)
             except ValueError as e:
-                logger.error(f"Error parsing search input: {e}")
+                logger.error("Error parsing search input: %s", e)
                 await update.message.reply_text(
                     "❌ Invalid format. Please use: CAR_PLATE, DD-MM-YYYY\n"
                     "Example: 1111111, 25-04-2025",
                     reply_markup=ADMIN_MENU
                 )
             except Exception as e:
-                logger.error(f"Error in search_logs: {e}")
+                logger.error("Error in search_logs: %s", e)
                 await update.message.reply_text("❌ Error searching logs. Please try again.", reply_markup=ADMIN_MENU)
     except Exception as e:
-        logger.error(f"Error in text_handler: {e}")
+        logger.error("Error in text_handler: %s", e)
         await update.message.reply_text("❌ An error occurred. Please try again.", reply_markup=ADMIN_MENU)
 
-@retry_gsheet_operation()
+@retry_gsheet_operation("❌ Error processing car action.")
 async def on_car_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     try:
-        action, plate = query.data.split("|")
+        action, plate = parse_callback(query.data)
+        await ensure_sheets()  # Loads car_state
         user = update.effective_user.first_name
         user_id = update.effective_user.id
         # Get current time in UAE time zone
         ts = datetime.now(UAE_TZ)
-        # Format the timestamp for display
-        ts_display = ts.strftime("%d-%m-%Y, %I:%M %p")
-        # Format the timestamp for storage in the Log worksheet
-        ts_storage = ts.strftime("%Y-%m-%d %H:%M")
-        normalized_plate = str(plate).strip().upper()
+        # Format the timestamp for display and for storage in the Log worksheet
+        ts_display, ts_storage = format_minute(ts.replace(second=0, microsecond=0))
         
         if action == "take":
             # Double-check if the driver already has a car
-            logs = sheet_log.get_all_records()
-            logs.sort(key=lambda x: x["Timestamp"])
-            last_action = {r["Car Plate"]: r["Action"] for r in logs}
-            user_cars = [cp for cp, rec in last_action.items() if rec == "out" and logs[list(last_action.keys()).index(cp)]["Driver Name"] == user]
+            user_cars = cars_held_by(user)
             if user_cars:
-                menu = COMBINED_MENU if user_id in ADMINS else MAIN_MENU
+                menu = menu_for(user_id)
                 await query.edit_message_text(f"🚫 You already have a car ({user_cars[0]}). Please return it before taking another.", reply_markup=menu)
                 return
             # Double-check if the car is already in use
-            if last_action.get(normalized_plate) == "out":
-                menu = COMBINED_MENU if user_id in ADMINS else MAIN_MENU
+            if is_car_out(plate):
+                menu = menu_for(user_id)
                 await query.edit_message_text(f"⚠️ Car {plate} is already in use by another driver.", reply_markup=menu)
                 return
-            # Log the take action
-            sheet_log.append_row([ts_storage, user, plate, "out"])
-            logger.debug(f"Logged take action: {user} took {plate} at {ts_storage}")
-            await query.edit_message_text(f"✅ You took {plate} at {ts_display}")
-            await context.bot.send_message(
-                chat_id=ADMIN_CHAT_ID,
-                text=f"🚗 {plate} taken by {user} at {ts_display}"
+            # Record the take in memory first so a concurrent take sees the car as out,
+            # then queue the log row for the batched writer
+            update_car_state(plate, "out", user, ts_storage)
+            log_queue.put_nowait([ts_storage, user, plate, "out"])
+            logger.debug("Logged take action: %s took %s at %s", user, plate, ts_storage)
+            await send_all(
+                query.edit_message_text(f"✅ You took {plate} at {ts_display}"),
+                context.bot.send_message(
+                    chat_id=ADMIN_CHAT_ID,
+                    text=f"🚗 {plate} taken by {user} at {ts_display}"
+                ),
             )
-            logger.debug(f"Notification sent to admin chat {ADMIN_CHAT_ID}: {plate} taken by {user}")
+            logger.debug("Notification sent to admin chat %s: %s taken by %s", ADMIN_CHAT_ID, plate, user)
         else:
-            sheet_log.append_row([ts_storage, user, plate, "in"])
-            logger.debug(f"Logged return action: {user} returned {plate} at {ts_storage}")
-            await query.edit_message_text(f"↩️ You returned {plate} at {ts_display}")
-            await context.bot.send_message(
-                chat_id=ADMIN_CHAT_ID,
-                text=f"✅ {plate} returned by {user} at {ts_display}"
+            update_car_state(plate, "in", user, ts_storage)
+            log_queue.put_nowait([ts_storage, user, plate, "in"])
+            logger.debug("Logged return action: %s returned %s at %s", user, plate, ts_storage)
+            await send_all(
+                query.edit_message_text(f"↩️ You returned {plate} at {ts_display}"),
+                context.bot.send_message(
+                    chat_id=ADMIN_CHAT_ID,
+                    text=f"✅ {plate} returned by {user} at {ts_display}"
+                ),
             )
-            logger.debug(f"Notification sent to admin chat {ADMIN_CHAT_ID}: {plate} returned by {user}")
+            logger.debug("Notification sent to admin chat %s: %s returned by %s", ADMIN_CHAT_ID, plate, user)
     except Exception as e:
-        logger.error(f"Error in on_car_action: {e}")
+        logger.error("Error in on_car_action: %s", e)
         await query.edit_message_text("❌ Error processing car action.")
 
+# Reply keyboard buttons send fixed strings, so route them with one dict lookup; any other
+# text is input the user was prompted for
+MENU_DISPATCH = {
+    "🛠️ Admin Panel": admin_menu,
+    "➕ Add Car": add_car_prompt,
+    "➖ Remove Car": remove_car_prompt,
+    "📋 Driver List": driver_list_menu,
+    "⬅️ Main Menu": back_to_main_menu,
+    "⬅ Main Menu": back_to_main_menu,
+    "🚗 Take Car": take_car_menu,
+    "↩️ Return Car": return_car_menu,
+    "📊 Status": status_menu,
+    "🔍 History": history_menu,
+}
+
+async def dispatch_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    handler = MENU_DISPATCH.get(update.message.text, text_handler)
+    await handler(update, context)
+
+# Route inline button presses on their action prefix instead of one regex handler per action
+CALLBACK_DISPATCH = {
+    "take": on_car_action,
+    "return": on_car_action,
+    "approve": handle_access_request,
+    "reject": handle_access_request,
+    "remove_driver": handle_driver_action,
+    "add_driver": handle_driver_action,
+    "remove_car": handle_remove_car_action,
+}
+
+async def dispatch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    action = (update.callback_query.data or "").partition("|")[0]
+    handler = CALLBACK_DISPATCH.get(action)
+    if handler is None:
+        # Informational buttons such as "(In Use)" have no action; just stop the spinner
+        await update.callback_query.answer()
+        return
+    await handler(update, context)
+
+# Initialize Sheets in the background at startup so the first update doesn't pay for it.
+# A failure here is only logged; the next request retries.
+async def warm_sheets():
+    try:
+        await ensure_sheets()
+    except Exception as e:
+        logger.warning("Google Sheets initialization at startup failed: %s", e)
+
+async def post_init(app):
+    app.bot_data["sheets_warmup"] = asyncio.create_task(warm_sheets())
+    app.bot_data["log_writer"] = asyncio.create_task(log_writer(app.bot))
+    app.bot_data["sheets_keepalive"] = asyncio.create_task(keep_sheets_warm())
+
+# Upper bound on writing out pending rows at shutdown
+SHUTDOWN_FLUSH_TIMEOUT = 60  # seconds
+
+async def post_shutdown(app):
+    app.bot_data["sheets_keepalive"].cancel()
+    # Let the writer drain the queue and the driver writes finish before exiting.
+    # Whatever is still pending at the deadline is cancelled, which logs its rows.
+    log_queue.put_nowait(None)
+    writer = app.bot_data["log_writer"]
+    _, pending = await asyncio.wait([writer, *_driver_writes], timeout=SHUTDOWN_FLUSH_TIMEOUT)
+    if pending:
+        logger.error("Sheets writes did not finish within %ss; cancelling them", SHUTDOWN_FLUSH_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    if writer in pending:
+        unsaved = [row for row in (log_queue.get_nowait() for _ in range(log_queue.qsize())) if row is not None]
+        if unsaved:
+            logger.error("Unsaved log rows: %s", unsaved)
+
 def main():
     try:
-        app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+        app = (
+            ApplicationBuilder()
+            .token(TELEGRAM_TOKEN)
+            # Handle updates concurrently so one slow Sheets call doesn't hold up every other user.
+            # Take/return checks and car_state updates run without an await in between, so they
+            # stay atomic on the event loop.
+            .concurrent_updates(True)
+            # Wait for a free connection under bursts instead of failing the send after 1s
+            .pool_timeout(TELEGRAM_POOL_TIMEOUT)
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
+            .build()
+        )
         app.add_handler(CommandHandler("start", start))
-        app.add_handler(MessageHandler(filters.Regex("^🛠️ Admin Panel$"), admin_menu))
-        app.add_handler(MessageHandler(filters.Regex("^➕ Add Car$"), add_car_prompt))
-        app.add_handler(MessageHandler(filters.Regex("^➖ Remove Car$"), remove_car_prompt))
-        app.add_handler(MessageHandler(filters.Regex("^📋 Driver List$"), driver_list_menu))
-        app.add_handler(MessageHandler(filters.Regex(r"^(⬅️ Main Menu|⬅\ufe0f Main Menu)$"), back_to_main_menu))
-        app.add_handler(MessageHandler(filters.Regex("^🚗 Take Car$"), take_car_menu))
-        app.add_handler(MessageHandler(filters.Regex("^↩️ Return Car$"), return_car_menu))
-        app.add_handler(MessageHandler(filters.Regex("^📊 Status$"), status_menu))
-        app.add_handler(MessageHandler(filters.Regex("^🔍 History$"), history_menu))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
-        app.add_handler(CallbackQueryHandler(on_car_action, pattern="^(take|return)\\|"))
-        app.add_handler(CallbackQueryHandler(handle_access_request, pattern="^(approve|reject)\\|"))
-        app.add_handler(CallbackQueryHandler(handle_driver_action, pattern="^(remove_driver|add_driver)"))
-        app.add_handler(CallbackQueryHandler(handle_remove_car_action, pattern="^remove_car\\|"))
+        app.add_handler(MessageHandler(filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND, dispatch_text))
+        app.add_handler(CallbackQueryHandler(dispatch_callback))
         logger.info("Bot started.")
-        app.run_polling(timeout=10)
+        if WEBHOOK_URL:
+            # Let Telegram push updates instead of long-polling getUpdates
+            app.run_webhook(
+                listen="0.0.0.0",
+                port=PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+            )
+        else:
+            app.run_polling(timeout=10)
     except Exception as e:
-        logger.error(f"Error in main: {e}")
+        logger.error("Error in main: %s", e)
 
 if __name__ == "__main__":
     main()